@@ -1,14 +1,111 @@
 import os
+import time
+import functools
+import multiprocessing
 import cv2
 import numpy as np
 from exception import file_create
 
 
+@functools.lru_cache(maxsize=16)
+def _compute_maps(cam_mat_bytes, dist_bytes, rect_bytes, proj_bytes, size):
+    """
+    Computes the undistortion and rectification maps of a camera.
+
+    The arrays are passed as bytes so that identical calibrations reuse the maps already computed.
+
+    :param cam_mat_bytes: Camera matrix (3x3, float64) as bytes
+    :param dist_bytes: Distortion coefficients (float64) as bytes
+    :param rect_bytes: Rectification transform (3x3, float64) as bytes
+    :param proj_bytes: Projection matrix (3x4, float64) as bytes
+    :param size: Size of the images in pixels
+    :return: Undistortion and rectification maps, in the fixed-point format (CV_16SC2 / CV_16UC1) used by cv2.remap
+    """
+    return cv2.initUndistortRectifyMap(np.frombuffer(cam_mat_bytes).reshape(3, 3),
+                                       np.frombuffer(dist_bytes),
+                                       np.frombuffer(rect_bytes).reshape(3, 3),
+                                       np.frombuffer(proj_bytes).reshape(3, 4),
+                                       size,
+                                       cv2.CV_16SC2)
+
+
+def _cuda_available():
+    """Returns True if OpenCV is built with CUDA and a CUDA device is available."""
+    try:
+        return cv2.cuda.getCudaEnabledDeviceCount() > 0
+    except (AttributeError, cv2.error):
+        return False
+
+
+def _detect_one(gray, pattern):
+    """
+    Detects and refines the chessboard corners in a grayscale image.
+
+    :param gray: Grayscale image
+    :param pattern: Number of inside corners of the chessboard (row, column)
+    :return: Refined corners, or None if the chessboard was not found
+    """
+    # Quickly reject the images without chessboard, the full detectors can stall on them
+    if hasattr(cv2, "checkChessboard"):
+        found = cv2.checkChessboard(gray, pattern)
+    else:
+        found = cv2.findChessboardCorners(gray, pattern, flags=cv2.CALIB_CB_FAST_CHECK)[0]
+    if not found:
+        return None
+
+    # The sector based detector is parallelized and already returns sub-pixel corners
+    ret, corners = cv2.findChessboardCornersSB(gray, pattern,
+                                               flags=cv2.CALIB_CB_NORMALIZE_IMAGE | cv2.CALIB_CB_EXHAUSTIVE |
+                                               cv2.CALIB_CB_ACCURACY)
+    if ret:
+        return corners
+
+    # Fall back to the classic detector for the hard images
+    ret, corners = cv2.findChessboardCorners(gray, pattern)
+    if not ret:
+        return None
+    cv2.cornerSubPix(gray, corners, (11, 11), (-1, -1),
+                     (cv2.TERM_CRITERIA_MAX_ITER + cv2.TERM_CRITERIA_EPS, 30, 0.01))
+    return corners
+
+
+def _read_and_detect(filename, pattern):
+    """
+    Reads a calibration image in grayscale and detects its chessboard corners, in a worker process.
+
+    :param filename: Name of the image file
+    :param pattern: Number of inside corners of the chessboard (row, column)
+    :return: Grayscale image and refined corners (None if the chessboard was not found)
+    """
+    gray = cv2.imread(filename, cv2.IMREAD_GRAYSCALE)
+    return gray, _detect_one(gray, pattern)
+
+
 class StereoCalibration:
+    #: Saved attributes: 'dict' for the attributes with a value per side, and the file formats to write
+    _SCHEMA = {
+        "cam_mats": ('dict', ('npy', 'csv')),
+        "dist_coefs": ('dict', ('npy', 'csv')),
+        "rot_mat": ('array', ('npy', 'csv')),
+        "trans_vec": ('array', ('npy', 'csv')),
+        "e_mat": ('array', ('npy', 'csv')),
+        "f_mat": ('array', ('npy', 'csv')),
+        "rect_trans": ('dict', ('npy', 'csv')),
+        "proj_mats": ('dict', ('npy', 'csv')),
+        "disp_to_depth_mat": ('array', ('npy', 'csv')),
+        "valid_boxes": ('dict', ('npy', 'csv')),
+        "undistortion_map": ('dict', ('npy',)),
+        "rectification_map": ('dict', ('npy',)),
+    }
+    #: Maximum number of elements of an array saved to a .csv file
+    _CSV_MAX_SIZE = 10_000
+
     def __str__(self):
         """Returns a string representation of the class attributes."""
         output = ""
         for key, item in self.__dict__.items():
+            if key.startswith("_"):
+                continue
             output += key + ":\n"
             output += str(item) + "\n"
         return output
@@ -35,66 +132,117 @@ class StereoCalibration:
         self.disp_to_depth_mat = None
         #: Bounding boxes for valid pixels
         self.valid_boxes = {"left": None, "right": None}
-        #: Undistortion maps for remapping
+        #: Undistortion maps for remapping (fixed-point integer coordinates, CV_16SC2)
         self.undistortion_map = {"left": None, "right": None}
-        #: Rectification maps for remapping
+        #: Rectification maps for remapping (fixed-point interpolation table indices, CV_16UC1)
         self.rectification_map = {"left": None, "right": None}
+        #: Device used to rectify ('cuda' or 'cpu'), chosen at the first rectification
+        self._device = None
+        #: Undistortion and rectification maps uploaded to the GPU, when CUDA is available
+        self._cuda_maps = {"left": None, "right": None}
+
+    def convert_maps(self):
+        """
+        Converts maps saved as floats by older calibrations to the fixed-point format used by cv2.remap.
+        The maps are uploaded to the GPU later, at the first rectification.
+        """
+        self._device = None
+        for side in ("left", "right"):
+            if self.undistortion_map[side] is None or self.rectification_map[side] is None:
+                continue
+            if self.undistortion_map[side].dtype == np.float32:
+                (self.undistortion_map[side],
+                 self.rectification_map[side]) = cv2.convertMaps(self.undistortion_map[side],
+                                                                 self.rectification_map[side],
+                                                                 cv2.CV_16SC2)
+
+    def upload_maps(self):
+        """
+        Chooses the device used to rectify and uploads the maps once to it: CUDA when available, otherwise the CPU.
+        Called at the first rectification, so that the GPU context is created where the images are rectified,
+        and not when the calibration is loaded.
+        """
+        self._cuda_maps = {"left": None, "right": None}
+        if _cuda_available():
+            self._device = 'cuda'
+            for side in ("left", "right"):
+                # cv2.cuda.remap only supports float maps
+                gpu_maps = (cv2.cuda_GpuMat(), cv2.cuda_GpuMat())
+                for gpu_map, float_map in zip(gpu_maps, cv2.convertMaps(self.undistortion_map[side],
+                                                                        self.rectification_map[side],
+                                                                        cv2.CV_32FC1)):
+                    gpu_map.upload(float_map)
+                self._cuda_maps[side] = gpu_maps
+        else:
+            self._device = 'cpu'
 
     def save_data(self):
         """Saves calibration data to .npy and .csv files."""
         try:
-            for key, item in self.__dict__.items():
-                if isinstance(item, dict):
+            for key, (kind, file_types) in self._SCHEMA.items():
+                if kind == 'dict':
                     # Save data for each side (left, right) if it is a dictionary
-                    for side in ("left", "right"):
-                        filename = f"{key}_{side}"
-                        file_create(self.__dict__[key][side], filename, 'npy', 'data')
-                        file_create(self.__dict__[key][side], filename, 'csv', 'data')
+                    items = {f"{key}_{side}": self.__dict__[key][side] for side in ("left", "right")}
                 else:
                     # Save data for non-dictionary attributes
-                    file_create(self.__dict__[key], key, 'npy', 'data')
-                    file_create(self.__dict__[key], key, 'csv', 'data')
+                    items = {key: self.__dict__[key]}
+                for filename, data in items.items():
+                    for file_type in file_types:
+                        # Large arrays are too slow to write and read as text
+                        if file_type == 'csv' and np.size(data) > self._CSV_MAX_SIZE:
+                            continue
+                        file_create(data, filename, file_type, 'data')
 
         except Exception as e:
             print(f"Error saving data to 'data': {e}")
 
     def rectify(self, frames):
         """Rectifies stereo images using the undistortion and rectification maps."""
+        if self._device is None:
+            self.upload_maps()
         new_frames = []
         for i, side in enumerate(("left", "right")):
+            if self._device == 'cuda':
+                # Apply remapping on the GPU with the maps already uploaded
+                gpu_frame = cv2.cuda_GpuMat()
+                gpu_frame.upload(frames[i])
+                new_frames.append(cv2.cuda.remap(gpu_frame, *self._cuda_maps[side], cv2.INTER_LINEAR).download())
+                continue
             # Apply remapping to correct distortion and rectify images
             new_frames.append(cv2.remap(frames[i],
                                         self.undistortion_map[side],
                                         self.rectification_map[side],
-                                        cv2.INTER_NEAREST))
+                                        cv2.INTER_LINEAR))
         return new_frames
 
     def load_data(self, directory):
         """Loads calibration parameters from .npy files in the specified directory."""
         try:
-            for key in self.__dict__.keys():
-                if isinstance(self.__dict__[key], dict):
+            for key, (kind, _) in self._SCHEMA.items():
+                if kind == 'dict':
                     for side in ("left", "right"):
                         filename = f"{directory}/{key}_{side}.npy"
                         if os.path.exists(filename):
-                            # Load data for each side (left, right) from .npy files
-                            self.__dict__[key][side] = np.load(filename)
+                            # Memory-map data for each side (left, right) from .npy files, pages are read on access
+                            self.__dict__[key][side] = np.load(filename, mmap_mode='r')
                         else:
                             print(f"File {filename} not found.")
                 else:
                     filename = f"{directory}/{key}.npy"
                     if os.path.exists(filename):
                         # Load data for non-dictionary attributes from .npy files
-                        self.__dict__[key] = np.load(filename)
+                        self.__dict__[key] = np.load(filename, mmap_mode='r')
                     else:
                         print(f"File {filename} not found.")
+            # Prepare the maps used for rectification
+            self.convert_maps()
             print("Data loading completed successfully.")
         except Exception as e:
             print(f"Error loading data: {e}")
 
 
 class Calibrator:
-    def __init__(self, row, column, square_size, image_size):
+    def __init__(self, row, column, square_size, image_size, debug=False, detect_timeout=60):
         """Initializes the Calibrator class with chessboard and image parameters."""
         #: Number of calibration images
         self.image_count = 0
@@ -106,41 +254,42 @@ class Calibrator:
         self.square_size = square_size
         #: Size of calibration images in pixels
         self.image_size = image_size
-        #: 3D coordinates of chessboard corners
-        pattern_size = (self.row, self.column)
-        corner_coordinates = np.zeros((np.prod(pattern_size), 3), np.float32)
-        corner_coordinates[:, :2] = np.indices(pattern_size).T.reshape(-1, 2)
-        corner_coordinates *= self.square_size
-        #: Real world corner coordinates found in each image
-        self.corner_coordinates = corner_coordinates
-        #: List of real world corner coordinates to match the corners found
-        self.object_points = []
+        #: Save the images with the detected corners drawn in the 'corner' folder
+        self.debug = debug
+        #: Maximum time in seconds for the corner detection of a pair, counted from its submission
+        self.detect_timeout = detect_timeout
+        # Grid of the chessboard corners, row by row as returned by the corner detection
+        y, x = np.mgrid[0:self.column, 0:self.row].astype(np.float32)
+        #: Real world (3D) corner coordinates found in each image
+        self.corner_coordinates = np.stack([x.ravel(), y.ravel(), np.zeros(x.size, np.float32)],
+                                           axis=1) * self.square_size
         #: List of found corner coordinates from calibration images for left and right cameras
         self.image_points = {"left": [], "right": []}
 
-    def corner_detect(self, image_pair):
-        """Detects and refines chessboard corners in a pair of images."""
-        side = "left"
-        self.object_points.append(self.corner_coordinates)
-
-        for image in image_pair:
-            img = np.copy(image)
-            gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-            ret, corners = cv2.findChessboardCorners(gray, (self.row, self.column))
-            if ret:
-                # Draw the detected corners on the image
-                cv2.drawChessboardCorners(img, (self.column, self.row), corners, ret)
-                cv2.cornerSubPix(gray, corners, (11, 11), (-1, -1),
-                                 (cv2.TERM_CRITERIA_MAX_ITER + cv2.TERM_CRITERIA_EPS, 30, 0.01))
-                # Save the image with detected corners
+    def add_corners(self, image_pair, corners_pair):
+        """Stores the chessboard corners found in a pair of images."""
+        if any(corners is None for corners in corners_pair):
+            print('Chessboard not found, pair skipped')
+            return
+
+        for side, image, corners in zip(("left", "right"), image_pair, corners_pair):
+            if self.debug:
+                # Draw the detected corners on a color copy of the image and save it
+                img = image.copy() if image.ndim == 3 else cv2.cvtColor(image, cv2.COLOR_GRAY2BGR)
+                cv2.drawChessboardCorners(img, (self.row, self.column), corners, True)
                 name = "corner/" + side + str(self.image_count + 1).zfill(2) + "corn"
                 file_create(img, name, 'png')
 
             # Append detected corners to the list of image points
             self.image_points[side].append(corners.reshape(-1, 2))
-            side = "right"
         self.image_count += 1
 
+    def corner_detect(self, image_pair):
+        """Detects and refines chessboard corners in a pair of images (BGR or grayscale)."""
+        pattern = (self.row, self.column)
+        grays = [cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) if image.ndim == 3 else image for image in image_pair]
+        self.add_corners(image_pair, [_detect_one(gray, pattern) for gray in grays])
+
     def calibrate_camera(self):
         """Calibrates the stereo cameras and computes the calibration matrices."""
         criteria = (cv2.TERM_CRITERIA_MAX_ITER + cv2.TERM_CRITERIA_EPS,
@@ -148,11 +297,13 @@ class Calibrator:
         flags = (cv2.CALIB_FIX_ASPECT_RATIO + cv2.CALIB_ZERO_TANGENT_DIST +
                  cv2.CALIB_SAME_FOCAL_LENGTH)
         calib = StereoCalibration()
+        # The same real world corner coordinates match the corners found in every image
+        object_points = [self.corner_coordinates] * len(self.image_points["left"])
 
         # Perform stereo calibration
         (calib.cam_mats["left"], calib.dist_coefs["left"],
          calib.cam_mats["right"], calib.dist_coefs["right"],
-         calib.rot_mat, calib.trans_vec, calib.e_mat, calib.f_mat) = cv2.stereoCalibrate(self.object_points,
+         calib.rot_mat, calib.trans_vec, calib.e_mat, calib.f_mat) = cv2.stereoCalibrate(object_points,
                                                                                          self.image_points["left"],
                                                                                          self.image_points["right"],
                                                                                          calib.cam_mats["left"],
@@ -183,13 +334,13 @@ class Calibrator:
         # Compute remapping elements for rectification
         for side in ("left", "right"):
             (calib.undistortion_map[side],
-             calib.rectification_map[side]) = cv2.initUndistortRectifyMap(
-                calib.cam_mats[side],
-                calib.dist_coefs[side],
-                calib.rect_trans[side],
-                calib.proj_mats[side],
-                self.image_size,
-                cv2.CV_32FC1)
+             calib.rectification_map[side]) = _compute_maps(
+                np.asarray(calib.cam_mats[side], np.float64).tobytes(),
+                np.asarray(calib.dist_coefs[side], np.float64).tobytes(),
+                np.asarray(calib.rect_trans[side], np.float64).tobytes(),
+                np.asarray(calib.proj_mats[side], np.float64).tobytes(),
+                tuple(self.image_size))
+        calib.convert_maps()
         print("Step 3 complete")
         return calib
 
@@ -199,16 +350,50 @@ class Calibrator:
         print('Start Calibration')
         print('Start reading images')
 
+        image_pairs = []
         while photo_counter != nbr_photo:
             photo_counter += 1
-            print('Importing pair No ' + str(photo_counter))
             left_name = image_folder + '/left' + str(photo_counter).zfill(2) + '.jpg'
             right_name = image_folder + '/right' + str(photo_counter).zfill(2) + '.jpg'
 
             if os.path.isfile(left_name) and os.path.isfile(right_name):
-                img_left = cv2.imread(left_name, 1)
-                img_right = cv2.imread(right_name, 1)
-                self.corner_detect((img_left, img_right))
+                image_pairs.append((left_name, right_name))
+
+        # The images are processed in parallel worker processes, which can be killed if a detection stalls.
+        # The pairs are submitted by batches of at most one image per worker, so every detection starts at once
+        # and its timeout is counted from its submission
+        pattern = (self.row, self.column)
+        batch_size = max(1, (os.cpu_count() or 1) // 2)
+        context = multiprocessing.get_context('spawn')  # The workers do not inherit the camera threads
+        pool = context.Pool(processes=2 * batch_size)
+        failed_pairs = 0
+        try:
+            for start in range(0, len(image_pairs), batch_size):
+                batch = image_pairs[start:start + batch_size]
+                deadline = time.monotonic() + self.detect_timeout
+                results = [[pool.apply_async(_read_and_detect, (name, pattern)) for name in pair] for pair in batch]
+                stalled = False
+                for pair, pair_results in zip(batch, results):
+                    print('Importing pair ' + pair[0] + ' / ' + pair[1])
+                    try:
+                        detections = [result.get(timeout=max(0.0, deadline - time.monotonic()))
+                                      for result in pair_results]
+                    except multiprocessing.TimeoutError:
+                        print('Corner detection timed out, pair failed')
+                        failed_pairs += 1
+                        stalled = True
+                        continue
+                    self.add_corners([gray for gray, _ in detections], [corners for _, corners in detections])
+                if stalled:
+                    # Kill the stalled detection and restart the workers for the next pairs
+                    pool.terminate()
+                    pool.join()
+                    pool = context.Pool(processes=2 * batch_size)
+        finally:
+            pool.terminate()
+            pool.join()
+        if failed_pairs:
+            print(f'{failed_pairs} pair(s) failed because of a corner detection timeout')
 
         print('End of cycle')
         print('Starting calibration... This may take several minutes!')
@@ -1,4 +1,5 @@
 import time
+from concurrent.futures import ThreadPoolExecutor
 from picamera2 import Picamera2, Preview
 import os
 import cv2  # OpenCV for displaying images
@@ -26,6 +27,38 @@ class DualCameraCapture:
         self.preview_type = preview_type
         self.capture_delay = capture_delay
         self.interval = interval
+        # Started cameras, opened on first use by the thread that captures
+        self._picams = {}
+        # Two worker threads to capture with both cameras at the same time, created on first use
+        self._executor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def get_camera(self, picam_id):
+        """
+        Returns the started camera with the specified ID, opening it on first use.
+
+        :param picam_id: ID of the camera to use
+        :return: Started Picamera2 instance
+        """
+        if picam_id not in self._picams:
+            # Create an instance of Picamera2 with the specified ID
+            picam = Picamera2(picam_id)
+            # Create preview configuration with the specified size, RGB888 gives BGR arrays as used by OpenCV
+            preview_config = picam.create_preview_configuration(main={"size": self.preview_size, "format": "RGB888"})
+            picam.configure(preview_config)
+            # Start the camera preview with the specified preview type
+            picam.start_preview(self.preview_type)
+            # Start capturing
+            picam.start()
+            # Delay to allow the camera to stabilize before capturing
+            time.sleep(self.capture_delay)
+            self._picams[picam_id] = picam
+        return self._picams[picam_id]
 
     def capture_and_save_image(self, picam_id, filename):
         """
@@ -34,22 +67,50 @@ class DualCameraCapture:
         :param picam_id: ID of the camera to use
         :param filename: Name of the file to save the image
         """
-        # Create an instance of Picamera2 with the specified ID
-        picam = Picamera2(picam_id)
-        # Create preview configuration with the specified size
-        preview_config = picam.create_preview_configuration(main={"size": self.preview_size})
-        picam.configure(preview_config)
-        # Start the camera preview with the specified preview type
-        picam.start_preview(self.preview_type)
-        # Start capturing
-        picam.start()
-        # Delay to allow the camera to stabilize before capturing
-        time.sleep(self.capture_delay)
         # Capture the image and save it to the specified file
-        metadata = picam.capture_file(filename)
+        metadata = self.get_camera(picam_id).capture_file(filename)
         print(f"Image captured {filename}: {metadata}")
-        # Close the camera after capturing
-        picam.close()
+
+    def capture_frame(self, picam_id):
+        """
+        Captures an image from the specified camera without saving it.
+
+        :param picam_id: ID of the camera to use
+        :return: Captured image as a BGR array
+        """
+        return self.get_camera(picam_id).capture_array()
+
+    def get_executor(self):
+        """
+        Returns the thread pool used to capture with both cameras at the same time, creating it on first use.
+
+        :return: ThreadPoolExecutor with two workers
+        """
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=2)
+        return self._executor
+
+    def capture_pair(self):
+        """
+        Captures an image from both cameras at the same time, without saving them.
+
+        :return: Captured left and right images as BGR arrays
+        """
+        # Open the cameras in this thread, only the captures run in the workers
+        cameras = [self.get_camera(self.left_cam_id), self.get_camera(self.right_cam_id)]
+        left_image, right_image = self.get_executor().map(lambda picam: picam.capture_array(), cameras)
+        return left_image, right_image
+
+    def close(self):
+        """
+        Closes the opened cameras and the capture threads.
+        """
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+        for picam in self._picams.values():
+            picam.close()
+        self._picams.clear()
 
     def display_images(self, left_filename, right_filename):
         """
@@ -58,9 +119,9 @@ class DualCameraCapture:
         :param left_filename: Name of the left image file
         :param right_filename: Name of the right image file
         """
-        # Read the images from the specified files
-        left_image = cv2.imread(left_filename)
-        right_image = cv2.imread(right_filename)
+        # Read the images from the specified files, directly in grayscale as they are displayed in gray
+        left_image = cv2.imread(left_filename, cv2.IMREAD_GRAYSCALE)
+        right_image = cv2.imread(right_filename, cv2.IMREAD_GRAYSCALE)
 
         # Display the images using the imported show_image function
         show_image("Left Image", left_image, cmap='gray')
@@ -95,9 +156,16 @@ class DualCameraCapture:
             left_filename = os.path.join(image_folder, f'left_{str(photo_counter + 1).zfill(2)}.png')
             right_filename = os.path.join(image_folder, f'right_{str(photo_counter + 1).zfill(2)}.png')
 
-            # Capture and save images for the left and right cameras
-            self.capture_and_save_image(self.left_cam_id, left_filename)
-            self.capture_and_save_image(self.right_cam_id, right_filename)
+            # Open the cameras in this thread, only the captures run in the workers
+            self.get_camera(self.left_cam_id)
+            self.get_camera(self.right_cam_id)
+
+            # Capture and save images for the left and right cameras at the same time
+            executor = self.get_executor()
+            futures = [executor.submit(self.capture_and_save_image, self.left_cam_id, left_filename),
+                       executor.submit(self.capture_and_save_image, self.right_cam_id, right_filename)]
+            for future in futures:
+                future.result()
 
             # Display the captured images for validation
             self.display_images(left_filename, right_filename)
@@ -1,7 +1,7 @@
 import cv2
 import numpy as np
 import matplotlib.pyplot as plt
-from exception import show_image
+from exception import post_image
 
 
 class DepthMapProcessor:
@@ -26,6 +26,8 @@ class DepthMapProcessor:
         self.kernel_size = kernel_size
         self.dilate_iterations = dilate_iterations
         self.erode_iterations = erode_iterations
+        # Kernel for morphological operations
+        self.kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (kernel_size, kernel_size))
         self.segmented_image = None
         self.contours = []
         self.mean_amplitudes = {}
@@ -37,15 +39,17 @@ class DepthMapProcessor:
         :param image: Image to process
         :return: Image after applying morphological operations
         """
-        # Create the kernel for morphological operations
-        kernel = np.ones((self.kernel_size, self.kernel_size), np.uint8)
-        # Apply dilation
-        dilated_image = cv2.dilate(image, kernel, iterations=self.dilate_iterations)
-        # Apply erosion on the dilated image
-        eroded_image = cv2.erode(dilated_image, kernel, iterations=self.erode_iterations)
-        # Apply dilation again on the eroded image
-        dilated_image2 = cv2.dilate(eroded_image, kernel, iterations=self.dilate_iterations)
-        return dilated_image2
+        # Dilation, erosion then dilation again, expressed as a closing of the common iterations
+        if self.dilate_iterations > self.erode_iterations:
+            image = cv2.dilate(image, self.kernel, iterations=self.dilate_iterations - self.erode_iterations)
+        processed_image = cv2.morphologyEx(image, cv2.MORPH_CLOSE, self.kernel,
+                                           iterations=min(self.dilate_iterations, self.erode_iterations))
+        # The remaining passes are applied in place to avoid new allocations
+        if self.erode_iterations > self.dilate_iterations:
+            cv2.erode(processed_image, self.kernel, dst=processed_image,
+                      iterations=self.erode_iterations - self.dilate_iterations)
+        cv2.dilate(processed_image, self.kernel, dst=processed_image, iterations=self.dilate_iterations)
+        return processed_image
 
     def calculate_mean_amplitude(self, contours):
         """
@@ -55,43 +59,49 @@ class DepthMapProcessor:
         :return: Dictionary of mean amplitudes for each contour
         """
         self.mean_amplitudes = {}
-        for i, contour in enumerate(contours):
-            if cv2.contourArea(contour) >= self.min_contour_area:
-                # Create a mask for the current contour
-                mask = np.zeros(self.depth_map_original.shape, dtype=np.uint8)
-                cv2.drawContours(mask, [contour], -1, 255, -1)
-                # Calculate the mean amplitude in the mask area
-                mean_amplitude = cv2.mean(self.depth_map_original, mask=mask)[0]
-                self.mean_amplitudes[i] = mean_amplitude
+        indices = [i for i, contour in enumerate(contours) if cv2.contourArea(contour) >= self.min_contour_area]
+        if not indices:
+            return self.mean_amplitudes
+
+        # Draw every contour in a single label image, the label of a contour being its position + 1
+        labels = np.zeros(self.depth_map_original.shape[:2], dtype=np.int32)
+        for label, i in enumerate(indices, start=1):
+            cv2.drawContours(labels, contours, i, label, -1)
+        # Calculate the mean amplitude of every label in one pass
+        sums = np.bincount(labels.ravel(), weights=self.depth_map_original.ravel(), minlength=len(indices) + 1)
+        counts = np.bincount(labels.ravel(), minlength=len(indices) + 1)
+        for label, i in enumerate(indices, start=1):
+            if counts[label] > 0:
+                self.mean_amplitudes[i] = sums[label] / counts[label]
         return self.mean_amplitudes
 
     def find_and_draw_contours(self, processed_image):
         """
-        Finds and draws contours in the processed image.
+        Finds contours in the processed image, calculates their mean amplitudes and draws them.
 
-        :param processed_image: Image after morphological operations
+        :param processed_image: Binary image after morphological operations
         :return: Image with contours drawn
         """
-        # Edge detection using Canny algorithm
-        edges = cv2.Canny(processed_image, 50, 150)
-        # Find contours in the edge image
-        contours, _ = cv2.findContours(edges, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+        # Find contours directly in the binary image, no edge detection is needed
+        contours, _ = cv2.findContours(processed_image, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+        self.contours = contours
+        # Keep the contours large enough and calculate their mean amplitudes
+        self.calculate_mean_amplitude(contours)
         # Convert processed image to color image for drawing contours
         image_with_contours = cv2.cvtColor(processed_image, cv2.COLOR_GRAY2BGR)
+        # Generate a color for each contour at once, with a fixed seed for a reproducible display
+        colors = np.random.default_rng(0).integers(0, 256, size=(len(contours), 3), dtype=np.uint8).tolist()
+
+        for i, mean_amplitude in self.mean_amplitudes.items():
+            contour = contours[i]
+            color = tuple(colors[i])
+            # Draw the contour on the image
+            cv2.drawContours(image_with_contours, [contour], -1, color, 2)
+            if mean_amplitude > 0:
+                # Draw the mean amplitude near the contour
+                x, y, w, h = cv2.boundingRect(contour)
+                cv2.putText(image_with_contours, f"{mean_amplitude:.2f}", (x, y - 10), cv2.FONT_HERSHEY_SIMPLEX, 0.5, color, 1)
 
-        for i, contour in enumerate(contours):
-            if cv2.contourArea(contour) >= self.min_contour_area:
-                # Generate a random color for each contour
-                color = tuple(np.random.randint(0, 256, size=3).tolist())
-                # Draw the contour on the image
-                cv2.drawContours(image_with_contours, [contour], -1, color, 2)
-                mean_amplitude = self.mean_amplitudes.get(i, 0)
-                if mean_amplitude > 0:
-                    # Draw the mean amplitude near the contour
-                    x, y, w, h = cv2.boundingRect(contour)
-                    cv2.putText(image_with_contours, f"{mean_amplitude:.2f}", (x, y - 10), cv2.FONT_HERSHEY_SIMPLEX, 0.5, color, 1)
-
-        self.contours = contours
         return image_with_contours
 
     def process_contour(self):
@@ -101,15 +111,13 @@ class DepthMapProcessor:
         """
         processed_image = self.apply_morphological_operations(self.segmented_image)
         # Display normalized depth map (commented out)
-        # show_image('Normalized Depth Map', processed_image)
+        # post_image('Normalized Depth Map', processed_image)
         processed_image_with_contours = self.find_and_draw_contours(processed_image)
 
-        self.mean_amplitudes = self.calculate_mean_amplitude(self.contours)
         for idx, mean_amplitude in self.mean_amplitudes.items():
             print(f'Contour {idx} : Mean Amplitude = {mean_amplitude:.2f}')
-        # Display image with contours and mean amplitudes (commented out)
-        processed_image_with_contours = self.find_and_draw_contours(processed_image)
-        show_image('Image with Contours and Means', processed_image_with_contours)
+        # Display image with contours and mean amplitudes
+        post_image('Image with Contours and Means', processed_image_with_contours)
         cv2.imwrite('contour.png', processed_image_with_contours)
 
     def process_disparity_image(self):
@@ -118,22 +126,32 @@ class DepthMapProcessor:
         and then applying contour processing on each segment.
         """
         # Display normalized disparity map (commented out)
-        # show_image('Normalized Disparity Map', self.depth_map_normalized)
+        # post_image('Normalized Disparity Map', self.depth_map_normalized)
+
+        if len(self.thresholds) < 2:
+            return
+
+        # Segment index of every pixel value, segment i + 1 holds the values in [thresholds[i], thresholds[i + 1])
+        # and the last segment also holds its upper threshold, 0 is used for the values outside the segments
+        thresholds = np.asarray(self.thresholds)
+        values = np.arange(256)
+        segment_lut = np.digitize(values, thresholds)
+        segment_lut[values == thresholds[-1]] = len(thresholds) - 1
+        segment_lut[segment_lut == len(thresholds)] = 0
+        # Label the whole disparity map and count the pixels of every segment in a single pass
+        segment_ids = cv2.LUT(self.depth_map_normalized, segment_lut.astype(np.uint8))
+        counts = np.bincount(segment_ids.ravel(), minlength=len(thresholds))
 
         for i in range(len(self.thresholds) - 1):
             lower_thresh = self.thresholds[i]
             upper_thresh = self.thresholds[i + 1]
-            # Create a mask for the current threshold
-            mask = cv2.inRange(self.depth_map_normalized, lower_thresh, upper_thresh)
-            # Apply the mask to extract the region of interest
-            self.segmented_image = cv2.bitwise_and(self.depth_map_normalized, self.depth_map_normalized, mask=mask)
-
-            hist = calculate_histogram(self.segmented_image)
-            non_zero_count = count_non_zero_pixels_from_histogram(hist)
+            non_zero_count = int(counts[i + 1])
 
             if non_zero_count >= self.pixel_min:
+                # The binary mask of the current segment is enough to extract its contours
+                self.segmented_image = cv2.inRange(segment_ids, i + 1, i + 1)
                 # Display the segment (commented out)
-                # show_image(f'Segment {i + 1}: {lower_thresh} - {upper_thresh}', self.segmented_image)
+                # post_image(f'Segment {i + 1}: {lower_thresh} - {upper_thresh}', self.segmented_image)
                 print(f'Number of non-zero pixels for segment {i + 1} ({lower_thresh} - {upper_thresh}): {non_zero_count}')
                 self.process_contour()
             else:
@@ -142,23 +160,12 @@ class DepthMapProcessor:
 
 def calculate_histogram(image):
     """
-    Calculates the histogram of pixel values of the image.
+    Calculates the histogram of pixel values of the 8-bit image in a single pass.
 
     :param image: Image to analyze
-    :return: Histogram of pixel values
-    """
-    hist = cv2.calcHist([image], [0], None, [256], [0, 256])
-    return hist.flatten()
-
-
-def count_non_zero_pixels_from_histogram(hist):
-    """
-    Counts the number of non-zero pixels from the pixel value histogram.
-
-    :param hist: Histogram of pixel values
-    :return: Total number of non-zero pixels
+    :return: Histogram of pixel values (256 bins)
     """
-    return int(np.sum(hist[1:]))
+    return np.bincount(image.ravel(), minlength=256)
 
 
 def plot_histogram(title, hist):
@@ -1,8 +1,13 @@
 import os
+import io
+import queue
 import cv2
 import numpy as np
 import csv
 
+# Analysis images posted by the pipeline threads, they are displayed by the GUI loop of the main thread
+_analysis_queue = queue.Queue()
+
 
 def folder_create(folder):
     """
@@ -24,7 +29,7 @@ def folder_create(folder):
         print(f"Folder '{folder}' already exists.")
 
 
-def file_create(data, file_name, file_type, folder_name=None):
+def file_create(data, file_name, file_type, folder_name=None, params=None):
     """
     This function creates a file of the specified type in the given folder (optional).
 
@@ -32,6 +37,7 @@ def file_create(data, file_name, file_type, folder_name=None):
     :param file_name: Name of the file to create (without extension)
     :param file_type: Type of file to create ('csv', 'image', 'npy', etc.)
     :param folder_name: Folder in which to create the file (optional)
+    :param params: Encoding parameters for images, e.g. [cv2.IMWRITE_PNG_COMPRESSION, 1] (optional)
     """
     # Build the full file path
     if folder_name:
@@ -43,12 +49,22 @@ def file_create(data, file_name, file_type, folder_name=None):
         # Check the file type and call the appropriate write function
         if file_type in ['jpg', 'png']:
             # For images (jpg, png formats), use OpenCV to save the image
-            cv2.imwrite(name, data)
+            cv2.imwrite(name, data, params if params is not None else [])
 
         elif file_type == 'npy':
             # For NumPy files (.npy), use NumPy to save the data
             np.save(name, data)
 
+        elif file_type == 'csv' and isinstance(data, np.ndarray):
+            # For NumPy arrays, format all the values at once and replace the dot with a comma
+            array = np.atleast_1d(data)
+            if array.ndim > 2:
+                array = array.reshape(-1, array.shape[-1])
+            buffer = io.BytesIO()
+            np.savetxt(buffer, array, delimiter=';', fmt='%.17g')
+            with open(name, 'wb') as csvfile:
+                csvfile.write(buffer.getvalue().replace(b'.', b','))
+
         elif file_type == 'csv':
             # For CSV files, use the csv module to write the data
             with open(name, 'w', newline='') as csvfile:
@@ -68,13 +84,13 @@ def file_create(data, file_name, file_type, folder_name=None):
         print(f"An error occurred while creating the file '{name}': {e}")
 
 
-def show_image(title, image, cmap='gray'):
+def apply_colormap(image, cmap='gray'):
     """
-    Displays an image with the specified colormap.
+    Applies the specified colormap to an image.
 
-    :param title: Title of the image window
-    :param image: Image to display
-    :param cmap: Colormap to apply to the image (default is 'gray')
+    :param image: Image to color
+    :param cmap: Colormap to apply to the image (default is 'gray', the image is returned unchanged)
+    :return: Colored image
     """
     # List of different OpenCV colormaps to apply colors
     colormaps = {
@@ -102,9 +118,73 @@ def show_image(title, image, cmap='gray'):
         "deepgreen": cv2.COLORMAP_DEEPGREEN
     }
     if cmap in colormaps:
-        image = cv2.applyColorMap(image, colormaps[cmap])
-    elif cmap != 'gray':
+        return cv2.applyColorMap(image, colormaps[cmap])
+    if cmap != 'gray':
         print("The selected color is not available. Default color applied")
-    cv2.imshow(title, image)
+    return image
+
+
+def show_image(title, image, cmap='gray'):
+    """
+    Displays an image with the specified colormap, and waits for a key.
+    It blocks the windows until a key is pressed, so it is only used from the main thread when no GUI loop runs
+    (e.g. during the calibration), the pipeline threads use post_image.
+
+    :param title: Title of the image window
+    :param image: Image to display
+    :param cmap: Colormap to apply to the image (default is 'gray')
+    """
+    cv2.imshow(title, apply_colormap(image, cmap))
     cv2.waitKey(0)
     cv2.destroyAllWindows()
+
+
+def post_image(title, image, cmap='gray'):
+    """
+    Sends an image to display to the GUI loop, without waiting. The window stays open until the GUI loop stops.
+
+    :param title: Title of the image window
+    :param image: Image to display
+    :param cmap: Colormap to apply to the image (default is 'gray')
+    """
+    # Copy the image, the caller may reuse its buffer before the GUI loop displays it
+    _analysis_queue.put((title, np.array(apply_colormap(image, cmap), copy=True)))
+
+
+def display_loop(displays, stop_event):
+    """
+    Run the OpenCV windows of every pipeline, OpenCV HighGUI is not thread-safe so it must be called from the
+    main thread. It displays the last frame of each pipeline and the analysis images, polls the keyboard once
+    per iteration and sends the pressed keys to every pipeline, as waitKey does not tell which window has the focus.
+    The 'q' key sets the stop event, which stops every pipeline.
+
+    :param displays: Dictionary of the window names, each with its single-slot frame queue and its key queue
+    :param stop_event: Event set when the display must stop
+    """
+    try:
+        while not stop_event.is_set():
+            # Display the last frame of each pipeline, if a new one is available
+            for window_name, (frame_queue, _) in displays.items():
+                try:
+                    cv2.imshow(window_name, frame_queue.get_nowait())
+                except queue.Empty:
+                    pass
+
+            # Display the analysis images posted since the last iteration
+            while True:
+                try:
+                    title, image = _analysis_queue.get_nowait()
+                except queue.Empty:
+                    break
+                cv2.imshow(title, image)
+
+            # Handle keyboard input, a single waitKey for all the windows
+            key = cv2.waitKey(1) & 0xFF
+            if key == ord('q'):  # Quit every pipeline if 'q' key is pressed
+                stop_event.set()
+            elif key != 0xFF:
+                for _, key_queue in displays.values():
+                    key_queue.put(key)
+    finally:
+        # Cleanup OpenCV windows
+        cv2.destroyAllWindows()
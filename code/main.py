@@ -1,5 +1,6 @@
-import multiprocessing
-from time import sleep
+import argparse
+import queue
+import threading
 import cv2
 import psutil
 import sys
@@ -10,10 +11,45 @@ import signal
 from tof_sensor import TofCamera
 from stereo_vision import StereoVision, DualCameraCapture
 from calibration_camera import Calibrator
-from exception import folder_create
-
-
-def calibrate_cameras(cam_capture):
+from exception import folder_create, display_loop
+
+
+def parse_arguments():
+    """Parses the command line arguments, which can also be read from a file given as @file."""
+    parser = argparse.ArgumentParser(description="Depth camera combining a ToF sensor and stereo vision.",
+                                     fromfile_prefix_chars='@')
+    parser.add_argument("--calibrate", action=argparse.BooleanOptionalAction, default=None,
+                        help="Calibrate the cameras before starting (asked if not given)")
+    parser.add_argument("--num-photos", type=int, help="Number of images to capture for calibration")
+    parser.add_argument("--rows", type=int, help="Number of rows on the checkerboard")
+    parser.add_argument("--cols", type=int, help="Number of columns on the checkerboard")
+    parser.add_argument("--square", type=float, default=2.4, help="Checkerboard square size (default: 2.4)")
+    args = parser.parse_args()
+
+    # Only ask the missing values when someone can answer, instead of blocking a non-interactive run
+    interactive = sys.stdin.isatty()
+    if args.calibrate is None:
+        if not interactive:
+            parser.error("--calibrate or --no-calibrate is required when the input is not interactive")
+        calib_choice = input("Do you want to calibrate the cameras (y/n)? ").strip().lower()
+        if calib_choice not in ("y", "n"):
+            parser.error("Invalid choice. Please enter 'y' or 'n'.")
+        args.calibrate = calib_choice == "y"
+
+    if args.calibrate:
+        prompts = {"num_photos": "Enter the number of images to capture for calibration: ",
+                   "rows": "Enter the number of rows on the checkerboard: ",
+                   "cols": "Enter the number of columns on the checkerboard: "}
+        for name, prompt in prompts.items():
+            if getattr(args, name) is None:
+                if not interactive:
+                    option = "--" + name.replace('_', '-')
+                    parser.error(f"{option} is required to calibrate when the input is not interactive")
+                setattr(args, name, int(input(prompt)))
+    return args
+
+
+def calibrate_cameras(cam_capture, nbr_photos, rows, columns, square_size=2.4):
     print("Starting camera calibration...")
 
     # Calibration parameters
@@ -22,52 +58,51 @@ def calibrate_cameras(cam_capture):
     image_size = (img_width, img_height)
 
     # Capture the necessary photos for calibration
-    nbr_photos = int(input("Enter the number of images to capture for calibration: "))
-    rows = int(input("Enter the number of rows on the checkerboard: "))
-    columns = int(input("Enter the number of columns on the checkerboard: "))
-    square_size = 2.4  # Checkerboard square size
-
     cam_capture.capture_images(nbr_photos=nbr_photos, image_folder="image")
 
+    # The calibration data is saved at the end of the calibration process
     calibrator = Calibrator(rows, columns, square_size, image_size)
-    calibration = calibrator.calibration_process(nbr_photos, 'image')
-
-    # Save calibration data
-    calibration.save('data')
+    calibrator.calibration_process(nbr_photos, 'image')
 
     print("Calibration completed.")
 
 
-def run_tof_camera(camera_queue):
+def run_tof_camera(stop_event, frame_queue, key_queue):
     tof_camera = TofCamera(max_distance=4)
-    tof_camera.continuous_display()
-    while True:
-        depth_buf = tof_camera.get_depth_buf()
-        depth_normalized = tof_camera.get_depth_normalized()
-        if depth_buf is not None and depth_normalized is not None:
-            camera_queue.put((depth_buf, depth_normalized))
-        sleep(1)
+    tof_camera.continuous_display(frame_queue, key_queue, stop_event)
 
 
-def run_stereo_vision():
+def run_stereo_vision(stop_event, frame_queue, key_queue):
     img_width = 840
     img_height = 820
     image_size = (img_width, img_height)
     cam_capture = DualCameraCapture(left_cam_id=2, right_cam_id=1, preview_size=image_size)
-    stereo_vision = StereoVision(cam_capture)
-    stereo_vision.process_and_display()
+    stereo_vision = StereoVision(cam_capture, stop_event=stop_event)
+    # Nothing is returned, the depth is only calculated for the frames analyzed with the 't' key
+    stereo_vision.process_and_display(frame_queue, key_queue)
+
 
-    disparity_normalized = stereo_vision.disparity_normalized
-    depth = stereo_vision.depth
-    return disparity_normalized, depth
+def run_pipeline(pipeline, stop_event, failures, frame_queue, key_queue):
+    """
+    Runs a pipeline in the current thread. When it ends or fails, the stop event is set to stop the other pipeline
+    and the GUI loop, and the error is recorded for the exit status.
+    """
+    try:
+        pipeline(stop_event, frame_queue, key_queue)
+    except Exception as e:
+        print(f"Pipeline {threading.current_thread().name} failed: {e}")
+        failures.append(threading.current_thread().name)
+    finally:
+        stop_event.set()
 
 
-def terminate_processes(processes):
-    """Terminates the given processes."""
-    for proc in processes:
-        if proc.is_alive():
-            proc.terminate()
-            proc.join()
+def stop_threads(threads, stop_event):
+    """Signals the given threads to stop and waits for them."""
+    stop_event.set()
+    for thread in threads:
+        thread.join(timeout=5)
+        if thread.is_alive():
+            print(f"Thread {thread.name} did not stop in time.")
 
 
 def kill_zombie_processes():
@@ -108,44 +143,50 @@ def cleanup():
 
 
 if __name__ == "__main__":
+    args = parse_arguments()
+
     folder_create('data')
     folder_create('image')
     folder_create('corner')
 
-    calib_choice = input("Do you want to calibrate the cameras (y/n)? ").strip().lower()
-
-    if calib_choice == "y":
-        cam_capture = DualCameraCapture(left_cam_id=2, right_cam_id=1, preview_size=(840, 820))
-        calibrate_cameras(cam_capture)
-    elif calib_choice == "n":
-        print("Cameras will not be calibrated.")
+    if args.calibrate:
+        # Close the cameras once calibrated so that the stereo vision thread can open them
+        with DualCameraCapture(left_cam_id=2, right_cam_id=1, preview_size=(840, 820)) as cam_capture:
+            calibrate_cameras(cam_capture, args.num_photos, args.rows, args.cols, args.square)
     else:
-        print("Invalid choice. Please enter 'y' or 'n'.")
-        exit(1)
+        print("Cameras will not be calibrated.")
+
+    # Event to stop both pipelines, set by the 'q' key or when a pipeline ends
+    stop_event = threading.Event()
+    # Names of the pipelines which failed
+    failures = []
 
-    # Initialize queues for inter-process communication
-    camera_queue = multiprocessing.Queue()
+    # Window of each pipeline, with its single-slot frame queue and the queue of the keys pressed in the GUI loop
+    displays = {"ToF Camera": (queue.Queue(maxsize=1), queue.Queue()),
+                "disparity": (queue.Queue(maxsize=1), queue.Queue())}
 
-    # Create processes
-    tof_process = multiprocessing.Process(target=run_tof_camera, args=(camera_queue,))
-    stereo_process = multiprocessing.Process(target=run_stereo_vision)
+    # Run both pipelines in threads of this process, which share their arrays, the heavy OpenCV calls release the GIL
+    tof_thread = threading.Thread(target=run_pipeline,
+                                  args=(run_tof_camera, stop_event, failures, *displays["ToF Camera"]),
+                                  name="tof", daemon=True)
+    stereo_thread = threading.Thread(target=run_pipeline,
+                                     args=(run_stereo_vision, stop_event, failures, *displays["disparity"]),
+                                     name="stereo", daemon=True)
 
-    # Start processes
-    tof_process.start()
-    stereo_process.start()
+    # Start threads
+    tof_thread.start()
+    stereo_thread.start()
 
-    processes = [tof_process, stereo_process]
+    threads = [tof_thread, stereo_thread]
 
-    # Wait for processes to finish
+    # Run the windows of both pipelines in the main thread, until 'q' is pressed or a pipeline ends
     try:
-        # Keep processes alive
-        while True:
-            sleep(1)
+        display_loop(displays, stop_event)
     except KeyboardInterrupt:
-        print("Interrupt detected. Stopping processes...")
+        print("Interrupt detected. Stopping threads...")
     finally:
-        # Stop processes
-        terminate_processes(processes)
-        print("All processes have been stopped.")
+        # Stop threads
+        stop_threads(threads, stop_event)
+        print("All threads have been stopped.")
         cleanup()
-        sys.exit(0)
+        sys.exit(1 if failures else 0)
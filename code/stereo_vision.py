@@ -1,18 +1,34 @@
 import cv2  # Import OpenCV for image processing
 import numpy as np  # Import NumPy for mathematical operations and image processing
-from multiprocessing import Process, Queue, Event  # Import modules for process management
+import queue  # Import queues to exchange frames and keys with the GUI loop
+import threading  # Import the event to stop the capture from another thread
 from calibration_camera import StereoCalibration  # Import the class for stereo calibration
 from exception import file_create  # Import the function for file creation
 from camera_control import DualCameraCapture  # Import the class for camera control
 from depth_traitement import DepthMapProcessor  # Import the class for depth map processing
 
-# Import the function show_image
-from exception import show_image
+
+def check_simd_support():
+    """
+    Check that OpenCV uses SIMD instructions (NEON / AVX2), which the StereoSGBM matching relies on.
+
+    :return: True if NEON or AVX2 code is available, otherwise False
+    """
+    cv2.setUseOptimized(True)
+    cpu_features = ""
+    for line in cv2.getBuildInformation().splitlines():
+        if line.strip().startswith(("Baseline:", "Dispatched code generation:")):
+            cpu_features += line
+    if cv2.useOptimized() and ("NEON" in cpu_features or "AVX2" in cpu_features):
+        return True
+    print("Warning: OpenCV is built without NEON/AVX2 optimizations, the disparity calculation will be slow")
+    return False
 
 
 class StereoVision:
     def __init__(self, cam_capture, baseline=0.06, focal_length=1300, block_size=15, P1=10 * 15, P2=64, min_disp=-16,
-                 max_disp=128, uniqueRatio=4, speckleWindowSize=200, speckleRange=4, disp12MaxDiff=0):
+                 max_disp=128, uniqueRatio=4, speckleWindowSize=200, speckleRange=4, disp12MaxDiff=0, backend='cpu',
+                 stop_event=None):
         """
         Initialize parameters for stereo vision.
 
@@ -28,6 +44,10 @@ class StereoVision:
         :param speckleWindowSize: Window size for speckle filtering
         :param speckleRange: Range of values for speckle filtering
         :param disp12MaxDiff: Maximum difference between left and right disparities
+        :param backend: 'cpu' for OpenCV StereoSGBM, 'cuda' for libSGM on the GPU. libSGM only supports 64, 128 or 256
+                        disparities (max_disp - min_disp) and needs P1 < P2, e.g. min_disp=0, max_disp=128, P1=10
+                        and P2=120 (the libSGM defaults)
+        :param stop_event: Optional threading Event to stop the capture from another thread
         """
         self.cam_capture = cam_capture  # Instance of the camera capture class
 
@@ -43,9 +63,12 @@ class StereoVision:
         # Dictionary to store images
         self.images = {"left": None, "right": None, "left_rectify": None, "right_rectify": None}
 
+        self.disparity_fixed = None  # Disparity as computed by the matcher (int16 fixed-point, disparity * 16)
         self.disparity = None
         self.disparity_normalized = None
-        self.depth = None
+        self.disparity_color = None  # Colored disparity map for display
+        self.depth = None  # Only calculated for the frames analyzed with the 't' key
+        self.band_rows = 80  # Rows of the bands converted at once, small enough to stay in the CPU cache
 
         # Parameters for depth camera filters
         self.block_size = block_size
@@ -59,8 +82,26 @@ class StereoVision:
         self.speckleRange = speckleRange
         self.disp12MaxDiff = disp12MaxDiff
 
-        # Event to stop processes
-        self.stop_event = Event()
+        # Stereo matching backend
+        self.backend = backend
+        self._sgm = None
+        self._sgbm = None
+        if backend == 'cuda':
+            # The libSGM matcher is created at the first disparity calculation, where the CUDA context is used
+            if self.num_disp not in (64, 128, 256):
+                raise ValueError(f"libSGM only supports 64, 128 or 256 disparities, got max_disp - min_disp = "
+                                 f"{self.num_disp} (use e.g. min_disp=0, max_disp=128)")
+            if not 0 < self.P1 < self.P2:
+                raise ValueError(f"libSGM needs 0 < P1 < P2, got P1={self.P1} and P2={self.P2} "
+                                 f"(use e.g. P1=10, P2=120)")
+        elif backend == 'cpu':
+            # The StereoSGBM matcher is created at the first disparity calculation, then reused
+            check_simd_support()
+        else:
+            raise ValueError(f"Unknown stereo matching backend '{backend}'")
+
+        # Event to stop the capture
+        self.stop_event = stop_event if stop_event is not None else threading.Event()
 
         self.n = 0  # Counter for the number of saved images
 
@@ -68,13 +109,9 @@ class StereoVision:
         """
         Capture and rectify stereo images.
         """
-        # Capture images from left and right cameras
-        self.cam_capture.capture_and_save_image(self.cam_capture.left_cam_id, 'left.png')
-        self.cam_capture.capture_and_save_image(self.cam_capture.right_cam_id, 'right.png')
-
-        # Read captured images in grayscale
-        for side in ("left", "right"):
-            self.images[side] = cv2.imread(side + '.png', 0)
+        # Capture images from left and right cameras at the same time and convert them in grayscale, in memory
+        for side, frame in zip(("left", "right"), self.cam_capture.capture_pair()):
+            self.images[side] = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
 
         # Rectify images using calibration data
         rectify_pair = self.calibration.rectify((self.images["left"], self.images["right"]))
@@ -85,18 +122,39 @@ class StereoVision:
         """
         Save images and the normalized disparity map.
         """
+        # Fast PNG compression, the files are bigger but the capture loop is not slowed down by zlib
+        params = [cv2.IMWRITE_PNG_COMPRESSION, 1]
         for side in ("left", "right", "left_rectify", "right_rectify"):
-            file_create(self.images[side], side + str(self.n), 'png')
+            file_create(self.images[side], side + str(self.n), 'png', params=params)
         if self.disparity_normalized is not None:
-            file_create(self.disparity_normalized, "depthmap" + str(self.n), 'png')
+            file_create(self.disparity_normalized, "depthmap" + str(self.n), 'png', params=params)
             self.n += 1
 
-    def depth_map_calcul(self):
+    def create_sgm(self):
         """
-        Calculate the disparity map from the rectified images.
+        Create the libSGM matcher of the CUDA backend.
+
+        :return: libSGM matcher
+        """
+        # Python bindings of sgm::LibSGMWrapper (fixstars/libSGM 3.x), only needed for the CUDA backend
+        import pysgm
+        return pysgm.LibSGMWrapper(numDisparity=self.num_disp,
+                                   P1=self.P1,
+                                   P2=self.P2,
+                                   # StereoSGBM keeps a disparity if every other cost * (100 - ratio) / 100 is higher
+                                   # than the best one, libSGM if every other cost * uniqueness is higher
+                                   uniquenessRatio=1.0 - self.uniquenessRatio / 100.0,
+                                   subpixel=True,  # Disparities scaled by 16 as with StereoSGBM
+                                   minDisparity=self.min_disp,
+                                   lrMaxDiff=self.disp12MaxDiff)
+
+    def create_sgbm(self):
+        """
+        Create the OpenCV StereoSGBM matcher of the CPU backend.
+
+        :return: StereoSGBM matcher
         """
-        # Create StereoSGBM object for disparity map calculation
-        stereo = cv2.StereoSGBM_create(
+        return cv2.StereoSGBM_create(
             minDisparity=self.min_disp,
             numDisparities=self.num_disp,
             blockSize=self.block_size,
@@ -105,27 +163,81 @@ class StereoVision:
             uniquenessRatio=self.uniquenessRatio,
             speckleWindowSize=self.speckleWindowSize,
             speckleRange=self.speckleRange,
-            disp12MaxDiff=self.disp12MaxDiff)
+            disp12MaxDiff=self.disp12MaxDiff,
+            # Full single-pass SGBM, the mode with the vectorized (universal intrinsics) code path
+            mode=cv2.STEREO_SGBM_MODE_SGBM)
 
-        # Calculate disparity
-        self.disparity = stereo.compute(self.images["left_rectify"], self.images["right_rectify"])
-        self.disparity = self.disparity.astype(np.float32) / 16.0  # Normalize for calculation
-        self.disparity[self.disparity < 0] = 0  # Filter negative values
-        # Normalize for display
-        self.disparity_normalized = cv2.normalize(self.disparity, None, alpha=255, beta=0, norm_type=cv2.NORM_MINMAX,
-                                                  dtype=cv2.CV_8U)
+    def depth_map_calcul(self):
+        """
+        Calculate the disparity map from the rectified images.
+        """
+        # Preallocate the int16 disparity once, the matcher writes in it for every frame
+        shape = self.images["left_rectify"].shape[:2]
+        if self.disparity_fixed is None or self.disparity_fixed.shape != shape:
+            self.disparity_fixed = np.empty(shape, dtype=np.int16)
+
+        if self.backend == 'cuda':
+            if self._sgm is None:
+                self._sgm = self.create_sgm()
+            # Calculate disparity on the GPU, libSGM writes in the given output (contiguous 8-bit inputs)
+            self._sgm.execute(np.ascontiguousarray(self.images["left_rectify"]),
+                              np.ascontiguousarray(self.images["right_rectify"]),
+                              self.disparity_fixed)
+        else:
+            # Create the matcher once, its internal buffers are reused for every frame
+            if self._sgbm is None:
+                self._sgbm = self.create_sgbm()
+
+            # Calculate disparity
+            self.disparity_fixed = self._sgbm.compute(self.images["left_rectify"], self.images["right_rectify"],
+                                                      self.disparity_fixed)
+        self.disparity_conversion()
+
+    def allocate_disparity_buffers(self, shape):
+        """
+        Allocate the disparity and depth maps reused for every frame, if the frame shape changed.
 
-    def depth_calcul(self):
+        :param shape: Shape of the disparity map
+        """
+        if self.disparity is None or self.disparity.shape != shape:
+            self.disparity = np.empty(shape, dtype=np.float32)
+            self.depth = np.zeros(shape, dtype=np.float32)
+        if self.disparity_normalized is None or self.disparity_normalized.shape != shape:
+            self.disparity_normalized = np.empty(shape, dtype=np.uint8)
+            self.disparity_color = np.empty(shape + (3,), dtype=np.uint8)
+
+    def disparity_conversion(self, compute_depth=False):
+        """
+        Convert the fixed-point disparity of the matcher to the disparity in pixels, and normalize it for display.
+        The map is processed by bands of rows, so that the intermediate results of a band stay in the CPU cache.
+
+        :param compute_depth: If True, also calculate the depth of each band
+        """
+        self.allocate_disparity_buffers(self.disparity_fixed.shape)
+        for start in range(0, self.disparity_fixed.shape[0], self.band_rows):
+            rows = slice(start, start + self.band_rows)
+            disparity = self.disparity[rows]
+            # Convert to float and normalize for calculation in a single pass
+            np.multiply(self.disparity_fixed[rows], 1.0 / 16.0, out=disparity, dtype=np.float32)
+            np.maximum(disparity, 0.0, out=disparity)  # Filter negative values in place, without a mask
+            # Normalize for display in a single pass, with the same scale on every frame
+            cv2.convertScaleAbs(disparity, dst=self.disparity_normalized[rows], alpha=255.0 / self.max_disp, beta=0.0)
+            if compute_depth:
+                self.depth_calcul(rows)
+
+    def depth_calcul(self, rows=slice(None)):
         """
         Calculate the depth for each pixel from the disparity map.
+
+        :param rows: Band of rows to calculate (all the rows by default)
         """
-        # Initialize depth
-        self.depth = np.zeros_like(self.disparity)
-        valid_disparity_mask = (self.disparity > 0)
-        # Calculate depth
-        self.depth[valid_disparity_mask] = self.focal_length * self.baseline / self.disparity[valid_disparity_mask]
+        disparity, depth = self.disparity[rows], self.depth[rows]
+        # Initialize depth, 0 where the disparity is not valid
+        depth.fill(0)
+        # Calculate depth in a single pass, only where the disparity is valid
+        np.divide(self.focal_length * self.baseline, disparity, out=depth, where=disparity > 0)
         # Use this line for a use in water
-        #self.depth[valid_disparity_mask] = self.focal_length_water * self.baseline / self.disparity[valid_disparity_mask]
+        #np.divide(self.focal_length_water * self.baseline, disparity, out=depth, where=disparity > 0)
 
     def process_stereo(self):
         """
@@ -142,78 +254,45 @@ class StereoVision:
         )
         processor_stereo.process_disparity_image()
 
-    def capture_and_compute(self, queue):
-        """
-        Capture images, calculate the disparity and depth maps, then place the results in a queue.
-
-        :param queue: Queue to transmit results between processes
+    def process_and_display(self, frame_queue, key_queue):
         """
-        while not self.stop_event.is_set():
-            # Capture and process stereo images
-            self.stereo_taking()
-            self.depth_map_calcul()
-            self.depth_calcul()
-            # Place results in the queue
-            queue.put((self.disparity_normalized, self.depth))
-
-        # Ensure the queue is empty before exiting
-        queue.put((None, None))  # Send end-of-processing signal to the display process
-
-        print("Image capture and processing stopped.")
+        Capture images, calculate the disparity map, then send the colored disparity to the GUI loop.
+        The images are saved and processed here when the matching keys are pressed in the GUI loop.
 
-    def depth_map_display(self, queue):
+        :param frame_queue: Single-slot queue of the colored disparity maps to display by the GUI loop
+        :param key_queue: Queue of the keys pressed in the GUI loop
         """
-        Display the disparity and depth maps from the results in the queue.
-
-        :param queue: Queue to get the computed results
-        """
-        while not self.stop_event.is_set() or not queue.empty():
-            if not queue.empty():
-                self.disparity_normalized, self.depth = queue.get()
-                # Apply color map for better visualization
-                disparity_normalized_color = cv2.applyColorMap(self.disparity_normalized, cv2.COLORMAP_JET)
-                cv2.imshow("disparity", disparity_normalized_color)
-                key = cv2.waitKey(1)  # Wait for a short period for window events
-                if key == ord('q'):  # Quit if 'q' key is pressed
-                    self.stop_event.set()  # Signal the other process to stop
-                elif key == ord('s'):  # Save images and depth map if 's' key is pressed
+        try:
+            while not self.stop_event.is_set():
+                # Capture and process stereo images
+                self.stereo_taking()
+                self.depth_map_calcul()
+
+                # Apply color map for better visualization, in a buffer reused for every frame
+                cv2.applyColorMap(self.disparity_normalized, cv2.COLORMAP_JET, dst=self.disparity_color)
+
+                # Send a copy to the GUI loop (the color buffer is reused for the next frame)
+                if not frame_queue.full():
+                    try:
+                        frame_queue.put_nowait(self.disparity_color.copy())
+                    except queue.Full:
+                        pass  # Drop the frame, the GUI loop has not displayed the previous one yet
+
+                # Handle keyboard input, 'q' is handled by the GUI loop which sets the stop event
+                try:
+                    key = key_queue.get_nowait()
+                except queue.Empty:
+                    key = None
+                if key == ord('s'):  # Save images and depth map if 's' key is pressed
                     self.save_images()
-                elif key == ord('t'):  # Process stereo images if 't' key is pressed
+                elif key == ord('t'):  # Calculate the depth and analyze the objects if 't' key is pressed
+                    self.disparity_conversion(compute_depth=True)
                     self.process_stereo()
-        cv2.destroyAllWindows()
-
-    def process_and_display(self):
-        """
-        Create processes for capturing and computing images, and for displaying the results.
-        """
-        queue = Queue()
-
-        # Create processes
-        capture_process = Process(target=self.capture_and_compute, args=(queue,))
-        display_process = Process(target=self.depth_map_display, args=(queue,))
-
-        try:
-            # Start processes
-            capture_process.start()
-            display_process.start()
-
-            # Wait for processes to finish
-            capture_process.join()
-            display_process.join()
 
         except KeyboardInterrupt:
-            print("Interrupt detected. Stopping processes...")
-            self.stop_event.set()  # Signal processes to stop
+            print("Interrupt detected. Stopping stereo vision...")
 
         finally:
-            # Ensure processes are properly terminated
-            if capture_process.is_alive():
-                capture_process.terminate()
-                capture_process.join()
-
-            if display_process.is_alive():
-                display_process.terminate()
-                display_process.join()
-
-            # Cleanup OpenCV windows
-            cv2.destroyAllWindows()
+            # Close the cameras opened by this thread
+            self.cam_capture.close()
+            print("Image capture and processing stopped.")
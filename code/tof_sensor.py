@@ -1,9 +1,46 @@
-import sys  # Import for exception handling and system operations
+import queue  # Import queues to exchange frames and keys with the GUI loop
 import cv2  # Import OpenCV for image processing
 import numpy as np  # Import NumPy for mathematical operations
 import ArducamDepthCamera as ac  # Import library for the Arducam ToF camera
 from depth_traitement import DepthMapProcessor  # Import class for depth map processing
 
+try:
+    from numba import njit, prange  # Optional, fuses the frame processing in a single loop
+except ImportError:
+    njit = None
+
+if njit is not None:
+    # Fast-math without 'nnan' and 'ninf', which would let the compiler remove the NaN check below
+    @njit(parallel=True, fastmath={'nsz', 'arcp', 'contract', 'afn', 'reassoc'}, cache=True)
+    def _fuse_tof(depth, amplitude, max_distance, depth_out, normalized_out, result_out):
+        """
+        Process a frame in a single pass over the pixels: replace NaN depths by zero, normalize the depth
+        and mask it with the thresholded amplitude.
+
+        :param depth: Depth data, only read (it may be read-only memory of the camera SDK)
+        :param amplitude: Amplitude data
+        :param max_distance: Maximum distance to normalize the depth
+        :param depth_out: Output depth, without NaN (float32)
+        :param normalized_out: Output normalized depth
+        :param result_out: Output resulting image
+        """
+        depth_flat = depth.reshape(-1)
+        amplitude_flat = amplitude.reshape(-1)
+        depth_out_flat = depth_out.reshape(-1)
+        normalized_flat = normalized_out.reshape(-1)
+        result_flat = result_out.reshape(-1)
+        for i in prange(depth_flat.size):
+            d = depth_flat[i]
+            if np.isnan(d):
+                d = 0.0
+            depth_out_flat[i] = d
+            normalized = (1.0 - d / max_distance) * 255.0
+            normalized = min(max(normalized, 0.0), 255.0)
+            normalized_flat[i] = np.uint8(normalized)
+            result_flat[i] = normalized_flat[i] if amplitude_flat[i] > 7 else 0
+else:
+    _fuse_tof = None
+
 
 class TofCamera:
     def __init__(self, max_distance=4):
@@ -19,6 +56,12 @@ class TofCamera:
         self.depth_buf = None  # Buffer for depth data
         self.depth_normalized = None  # Normalized depth map for display
         self.result_image = None  # Resulting image after processing
+        self._result_frame = None  # Preallocated output of the fused frame processing
+        self._depth_frame = None  # Preallocated copy of the depth without NaN, the SDK frame is already released
+        # Preallocated frame buffers reused by the continuous display
+        self._amplitude_frame = None
+        self._median_frame = None
+        self._color_frame = None
         self.n = 0  # Counter for saved image names
 
     # Have to be implemented
@@ -34,18 +77,31 @@ class TofCamera:
         if self.depth_buf is None or self.amplitude_buf is None:
             raise ValueError("Depth buffer and amplitude buffer must not be None.")
 
-        # Convert NaN values to zero for the depth buffer
-        self.depth_buf = np.nan_to_num(self.depth_buf)
-        # Threshold amplitude data
-        self.amplitude_buf = np.where(self.amplitude_buf <= 7, 0, 255)
-
-        # Normalize depth data
+        # Allocate the outputs once, they are reused for every frame
+        if self._result_frame is None or self._result_frame.shape != self.depth_buf.shape:
+            self._result_frame = np.empty(self.depth_buf.shape, dtype=np.uint8)
+            self._depth_frame = np.empty(self.depth_buf.shape, dtype=np.float32)
+            self.depth_normalized = np.empty(self.depth_buf.shape, dtype=np.uint8)
+
+        if _fuse_tof is not None:
+            _fuse_tof(self.depth_buf, self.amplitude_buf, float(self.max_distance),
+                      self._depth_frame, self.depth_normalized, self._result_frame)
+            self.depth_buf = self._depth_frame
+            return self._result_frame
+
+        # Convert NaN values to zero, in the copy of the depth buffer
+        np.copyto(self._depth_frame, self.depth_buf)
+        np.nan_to_num(self._depth_frame, copy=False)
+        self.depth_buf = self._depth_frame
+        # Threshold amplitude data, directly as a uint8 mask (uint8 scalars, so no int64 intermediate)
+        self.amplitude_buf = np.where(self.amplitude_buf <= 7, np.uint8(0), np.uint8(255))
+
+        # Normalize depth data, in the preallocated normalized depth
         normalized_depth = (1 - (self.depth_buf / self.max_distance)) * 255
-        normalized_depth = np.clip(normalized_depth, 0, 255).astype(np.uint8)
-        self.depth_normalized = normalized_depth
+        np.clip(normalized_depth, 0, 255, out=normalized_depth)
+        np.copyto(self.depth_normalized, normalized_depth, casting='unsafe')
         # Combine normalized depth and amplitude data
-        result_frame = normalized_depth & self.amplitude_buf.astype(np.uint8)
-        return result_frame
+        return cv2.bitwise_and(self.depth_normalized, self.amplitude_buf, dst=self._result_frame)
 
     def capture_image(self):
         """
@@ -75,28 +131,48 @@ class TofCamera:
             )
         processor.process_disparity_image()
 
-    def apply_median_filter(self, image: np.ndarray, ksize: int = 5) -> np.ndarray:
+    def apply_median_filter(self, image: np.ndarray, ksize: int = 5, dst: np.ndarray = None) -> np.ndarray:
         """ Apply a median filter at the image
         :param image : input image
         :param ksize : Kernel size of the median filter
+        :param dst : Optional preallocated output image
         :return: Filtered image
         """
-        return cv2.medianBlur(image, ksize)
+        return cv2.medianBlur(image, ksize, dst=dst)
 
-    def continuous_display(self):
+    def allocate_buffers(self, shape):
         """
-        Continuously capture and display images from the ToF camera, with options to save and process images.
+        Allocate the frame buffers reused by the continuous display, if the frame shape changed.
+
+        :param shape: Shape of the depth and amplitude frames
+        """
+        if self._amplitude_frame is None or self._amplitude_frame.shape != shape:
+            self._amplitude_frame = np.empty(shape, dtype=np.float32)
+            self._median_frame = np.empty(shape, dtype=np.uint8)
+            self._color_frame = np.empty(shape + (3,), dtype=np.uint8)
+
+    def continuous_display(self, frame_queue, key_queue, stop_event=None):
+        """
+        Continuously capture images from the ToF camera and send them to the GUI loop, with options to save and
+        process images.
+
+        :param frame_queue: Single-slot queue of the colored frames to display by the GUI loop
+        :param key_queue: Queue of the keys pressed in the GUI loop
+        :param stop_event: Optional event set to stop the capture from another thread
+        :raises RuntimeError: If the camera cannot be opened or started
         """
         # Open the connection to the ToF camera and start the depth data stream
-        if self.cam.open(ac.TOFConnect.CSI, 0) != 0 or self.cam.start(ac.TOFOutput.DEPTH) != 0:
-            print("Failed to initialize or start the camera")
-            sys.exit(1)
+        if self.cam.open(ac.TOFConnect.CSI, 0) != 0:
+            raise RuntimeError("Failed to initialize the ToF camera")
+        if self.cam.start(ac.TOFOutput.DEPTH) != 0:
+            self.cam.close()
+            raise RuntimeError("Failed to start the ToF camera")
 
         # Set the maximum distance of the camera
         self.cam.setControl(ac.TOFControl.RANG, self.max_distance)
 
         try:
-            while True:
+            while stop_event is None or not stop_event.is_set():
                 # Capture a frame from the camera
                 self.frame = self.cam.requestFrame(200)
                 if self.frame is not None:
@@ -105,8 +181,11 @@ class TofCamera:
                     self.amplitude_buf = self.frame.getAmplitudeData()
                     self.cam.releaseFrame(self.frame)  # Release the frame after processing
 
-                    # Normalize and process amplitude data
-                    self.amplitude_buf = np.clip(self.amplitude_buf * (255 / 1024), 0, 255)
+                    # Normalize and process amplitude data, in a buffer reused for every frame
+                    self.allocate_buffers(self.amplitude_buf.shape)
+                    np.multiply(self.amplitude_buf, 255 / 1024, out=self._amplitude_frame)
+                    np.clip(self._amplitude_frame, 0, 255, out=self._amplitude_frame)
+                    self.amplitude_buf = self._amplitude_frame
 
                     # Process the frame to get the resulting image
                     self.result_image = self.process_frame()
@@ -114,19 +193,24 @@ class TofCamera:
                     # self.water_equation()
 
                     #Apply a median filter
-                    self.result_image = self.apply_median_filter(self.result_image)
+                    self.result_image = self.apply_median_filter(self.result_image, dst=self._median_frame)
 
                     # Apply a color map for better display
-                    self.result_image = cv2.applyColorMap(self.result_image, cv2.COLORMAP_JET)
-
-                    # Display the resulting image
-                    cv2.imshow("ToF Camera", self.result_image)
-
-                    # Handle keyboard input
-                    key = cv2.waitKey(1) & 0xFF
-                    if key == ord('q'):  # Quit if 'q' key is pressed
-                        break
-                    elif key == ord('s'):  # Save the image if 's' key is pressed
+                    self.result_image = cv2.applyColorMap(self.result_image, cv2.COLORMAP_JET, dst=self._color_frame)
+
+                    # Send a copy to the GUI loop (the color buffer is reused for the next frame)
+                    if not frame_queue.full():
+                        try:
+                            frame_queue.put_nowait(self.result_image.copy())
+                        except queue.Full:
+                            pass  # Drop the frame, the GUI loop has not displayed the previous one yet
+
+                    # Handle keyboard input, 'q' is handled by the GUI loop which sets the stop event
+                    try:
+                        key = key_queue.get_nowait()
+                    except queue.Empty:
+                        key = None
+                    if key == ord('s'):  # Save the image if 's' key is pressed
                         self.capture_image()
                     elif key == ord('t'):  # Process depth data if 't' key is pressed
                         self.process_tof()
@@ -140,11 +224,10 @@ class TofCamera:
 
     def cleanup(self):
         """
-        Stop and close the camera, and destroy all OpenCV windows.
+        Stop and close the camera, the OpenCV windows are destroyed by the GUI loop.
         """
         self.cam.stop()
         self.cam.close()
-        cv2.destroyAllWindows()
 
     def get_depth_buf(self):
         """